@@ -2,35 +2,66 @@
 A MCP server that uses the dfhack_client_python package to connect to a locally running Dwarf Fortress game through DFHack's RPC connection.
 """
 
+import asyncio
+import logging
+import operator
+import os
+import socket
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request
+import msgspec
+from async_lru import alru_cache
+from fastapi import FastAPI, Query
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi_mcp import FastApiMCP
+from pydantic import BaseModel
+from dfhack_client_python import dfhack_remote
 from dfhack_client_python.dfhack_remote import connect, close
 from dfhack_client_python.dfhack import (GetVersion, GetDFVersion, GetUnitList, GetWorldInfo,
-GetViewInfo, ListUnits)
+GetViewInfo, ListUnits, GetPartialCreatureRaws)
 from dfhack_client_python.py_export.BasicApi_pb2 import ListUnitsIn, GetWorldInfoOut
+from dfhack_client_python.py_export.RemoteFortressReader_pb2 import ListRequest
+
+logger = logging.getLogger(__name__)
+
+def enable_dfhack_keepalive():
+    """Enable TCP keep-alive on the DFHack RPC socket so a dead game connection is detected while idle"""
+    # TCP_NODELAY needs no handling here, asyncio already sets it on every TCP transport
+    writer = getattr(dfhack_remote, "writer", None)
+    sock = writer.get_extra_info("socket") if writer is not None else None
+    if sock is None:
+        logger.warning("DFHack RPC socket not found on dfhack_remote, TCP keep-alive not enabled")
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Connect to DFHack on startup and close the connection when the server shuts down"""
     await connect()
-    #TODO: Need to prefetch and cache static data like materials, units, etc.
+    enable_dfhack_keepalive()
+    # Race id -> creature raw token, filled in as units of each race are seen
+    app.state.race_names = {}
+    app.state.versions = None
     yield
     await close()
 
 app = FastAPI(
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 @app.get("/get-versions", operation_id="get_versions")
 async def get_versions():
     """Get the DFHack and Dwarf Fortress versions for connected server"""
-    dfhack_version = (await GetVersion()).value
-    dwarf_fortress_version = (await GetDFVersion()).value
-    return {
-        "dfhackVersion": dfhack_version,
-        "dwarfFortressVersion": dwarf_fortress_version
-    }
+    # Versions can't change while the connection is open, so only ask DFHack once
+    if app.state.versions is None:
+        # Not gathered: both RPCs share the single DFHack stream and can't be in flight at once
+        dfhack_version = (await GetVersion()).value
+        dwarf_fortress_version = (await GetDFVersion()).value
+        app.state.versions = {
+            "dfhackVersion": dfhack_version,
+            "dwarfFortressVersion": dwarf_fortress_version
+        }
+    return app.state.versions
 
 @app.get("/get-world-info", operation_id="get_world_info")
 async def get_world_info():
@@ -57,83 +88,175 @@ async def get_world_info():
         "details": details
     }
 
+VIEW_INFO_FIELDS = (
+    "view_pos_x",
+    "view_pos_y",
+    "view_pos_z",
+    "view_size_x",
+    "view_size_y",
+    "cursor_pos_x",
+    "cursor_pos_y",
+    "cursor_pos_z",
+    "follow_unit_id",
+    "follow_item_id"
+)
+get_view_info_fields = operator.attrgetter(*VIEW_INFO_FIELDS)
+
 @app.get("/get-view-info", operation_id="get_view_info")
 async def get_view_info():
     """Get the view info for the currently running game"""
     view_info = await GetViewInfo()
-    return {
-        "view_pos_x": view_info.view_pos_x,
-        "view_pos_y": view_info.view_pos_y,
-        "view_pos_z": view_info.view_pos_z,
-        "view_size_x": view_info.view_size_x,
-        "view_size_y": view_info.view_size_y,
-        "cursor_pos_x": view_info.cursor_pos_x,
-        "cursor_pos_y": view_info.cursor_pos_y,
-        "cursor_pos_z": view_info.cursor_pos_z,
-        "follow_unit_id": view_info.follow_unit_id,
-        "follow_item_id": view_info.follow_item_id
-    }
+    return dict(zip(VIEW_INFO_FIELDS, get_view_info_fields(view_info)))
 
-@app.post("/list-units", operation_id="list_units")
-async def list_units(request: Request):
-    """Get details for the units with the given ids. Parameters: unit_ids[int]"""
-    unit_ids = (await request.json())["unit_ids"]
-    print("Unit IDs: " + str(unit_ids))
+@app.get("/get-view-info-protobuf", operation_id="get_view_info_protobuf", response_model=None)
+async def get_view_info_protobuf():
+    """Get the view info for the currently running game as a serialized ViewInfo protobuf message"""
+    view_info = await GetViewInfo()
+    return Response(content=view_info.SerializeToString(), media_type="application/x-protobuf")
+
+class Position(msgspec.Struct):
+    x: int
+    y: int
+    z: int
+
+class UnitName(msgspec.Struct, rename="camel"):
+    first_name: str
+    language_id: int
+    last_name: str
+    english_name: str
+
+class UnitDetails(msgspec.Struct, rename="camel"):
+    unit_id: int
+    name: UnitName
+    flags1: int
+    flags2: int
+    flags3: int
+    race: int
+    race_name: str | None
+    caste: int
+    gender: int
+    civ_id: int
+    histfig_id: int
+    position: Position
+    profession: int
+
+class ListUnitsOut(msgspec.Struct):
+    units: list[UnitDetails]
+
+class UnitSummary(msgspec.Struct, rename="camel"):
+    id: int
+    position: Position
+    is_soldier: bool
+    name: str
+    physical_description: str
+    profession_id: int
+    age: int
+
+# The unit builders below run in worker threads via asyncio.to_thread so a large batch doesn't stall the event loop
+def build_unit_details(units, races):
+    """Build the list_units response entries for the given BasicUnitInfo messages"""
+    return [UnitDetails(
+        unit_id=unit.unit_id,
+        name=UnitName(
+            first_name=unit.name.first_name,
+            language_id=unit.name.language_id,
+            last_name=unit.name.last_name,
+            english_name=unit.name.english_name
+        ),
+        flags1=unit.flags1,
+        flags2=unit.flags2,
+        flags3=unit.flags3,
+        race=unit.race,
+        race_name=races.get(unit.race),
+        caste=unit.caste,
+        gender=unit.gender,
+        civ_id=unit.civ_id,
+        histfig_id=unit.histfig_id,
+        position=Position(x=unit.pos_x, y=unit.pos_y, z=unit.pos_z),
+        profession=unit.profession
+    ) for unit in units]
+
+get_unit_summary_fields = operator.attrgetter(
+    "id", "pos_x", "pos_y", "pos_z", "is_soldier", "name", "appearance", "profession_id", "age"
+)
+
+def build_unit_summaries(creatures):
+    """Build the get_unit_list response entries for the given UnitDefinition messages"""
+    return [UnitSummary(
+        id=unit_id,
+        position=Position(x=pos_x, y=pos_y, z=pos_z),
+        is_soldier=is_soldier,
+        name=name,
+        physical_description=appearance.physical_description,
+        profession_id=profession_id,
+        age=age
+    ) for unit_id, pos_x, pos_y, pos_z, is_soldier, name, appearance, profession_id, age
+        in map(get_unit_summary_fields, creatures)]
+
+UNIT_STREAM_BATCH_SIZE = 256
+
+def encode_unit_summaries(creatures):
+    """Encode the get_unit_list entries as comma separated JSON objects, without the enclosing brackets"""
+    return msgspec.json.encode(build_unit_summaries(creatures))[1:-1]
+
+async def stream_unit_list(creatures):
+    """Yield the get_unit_list JSON document in batches so large forts aren't buffered whole"""
+    yield b'{"unitCount":%d,"units":[' % len(creatures)
+    for start in range(0, len(creatures), UNIT_STREAM_BATCH_SIZE):
+        chunk = await asyncio.to_thread(encode_unit_summaries, creatures[start:start + UNIT_STREAM_BATCH_SIZE])
+        yield chunk if start == 0 else b"," + chunk
+    yield b"]}"
+
+async def fetch_race_names(race_ids):
+    """Resolve the creature raw tokens for the given race ids, requesting only races not seen before"""
+    race_names = app.state.race_names
+    for race_id in race_ids - race_names.keys():
+        creature_id = None
+        if race_id >= 0:
+            # One creature per request, the full raws carry every caste, body part and tissue
+            creature_raws = await GetPartialCreatureRaws(input = ListRequest(list_start = race_id, list_end = race_id + 1))
+            creature_id = next((creature.creature_id for creature in creature_raws.creature_raws), None)
+        race_names[race_id] = creature_id
+    return race_names
+
+class ListUnitsBody(BaseModel):
+    unit_ids: list[int]
+
+@alru_cache(maxsize=64, ttl=1.0)
+async def fetch_unit_details(unit_ids: tuple[int, ...]) -> bytes:
+    """Fetch and encode the list_units response. Cached briefly so clients polling the same units share one RPC"""
     units = await ListUnits(input = ListUnitsIn(id_list = unit_ids))
-    unit_details = []
-    for unit in units.value:
-        unit_details.append({
-            "unitId": unit.unit_id,
-            "name": {
-                "firstName": unit.name.first_name,
-                "languageId": unit.name.language_id,
-                "lastName": unit.name.last_name,
-                "englishName": unit.name.english_name
-            },
-            "flags1": unit.flags1,
-            "flags2": unit.flags2, 
-            "flags3": unit.flags3,
-            "race": unit.race,
-            "caste": unit.caste,
-            "gender": unit.gender,
-            "civId": unit.civ_id,
-            "histfigId": unit.histfig_id,
-            "position": {
-                "x": unit.pos_x,
-                "y": unit.pos_y, 
-                "z": unit.pos_z
-            },
-            "profession": unit.profession
-        })
-    return {"units": unit_details}
-
-@app.get("/get-unit-list", operation_id="get_unit_list")
+    races = await fetch_race_names({unit.race for unit in units.value})
+    unit_details = await asyncio.to_thread(build_unit_details, units.value, races)
+    return msgspec.json.encode(ListUnitsOut(units=unit_details))
+
+@app.post("/list-units", operation_id="list_units", response_model=None)
+async def list_units(body: ListUnitsBody):
+    """Get details for the units with the given ids. Parameters: unit_ids[int]"""
+    logger.debug("Unit IDs: %s", body.unit_ids)
+    content = await fetch_unit_details(tuple(body.unit_ids))
+    return Response(content, media_type="application/json")
+
+@app.get("/list-units", operation_id="list_units_query", response_model=None)
+async def list_units_query(unit_ids: list[int] = Query()):
+    """Get details for the units with the given ids passed as repeated unit_ids query parameters"""
+    logger.debug("Unit IDs: %s", unit_ids)
+    content = await fetch_unit_details(tuple(unit_ids))
+    return Response(content, media_type="application/json")
+
+@app.get("/get-unit-list", operation_id="get_unit_list", response_model=None)
 async def get_unit_list():
     """Get the list of units in the currently running game"""
+    # GetUnitList takes no filter or field mask, and ListUnits' BasicUnitInfo has no soldier flag,
+    # appearance or age, so the full creature list has to be fetched for this summary
     units = await GetUnitList()
-    unit_details = []
-    for unit in units.creature_list:
-        unit_details.append({
-            "id": unit.id,
-            "position": {
-                "x": unit.pos_x,
-                "y": unit.pos_y,
-                "z": unit.pos_z
-            },
-            "isSoldier": unit.is_soldier,
-            "name": unit.name,
-            "physicalDescription": unit.appearance.physical_description,
-            "professionId": unit.profession_id,
-            "age": unit.age
-        })
-    return { "unitCount": len(units.creature_list), "units": unit_details }
+    return StreamingResponse(stream_unit_list(units.creature_list), media_type="application/json")
 
 # TODO:
 # - RunCommand (Run a DFHack command)
 # - GetBlockList (Get MapBlock info for all blocks in a 3d volume)
 # - GetPlantList? (Not sure how usefull this is as the PlatDef type only gives a location and an index ...)
 # - GetUnitListInside (GetListOf)
-# - GetViewInfo (very useful for determining what the player is currently seeing)
 # - PassKeyboardEvent (for perfomring shortcuts for the player maybe. Might be better with RunCommmand)
 # - SetPauseState
 # - GetPauseState
@@ -142,10 +265,16 @@ async def get_unit_list():
 mcp = FastApiMCP(
     app,
     name="Dwarf Fortress MCP Server",
-    description="A MCP server that uses the dfhack_client_python package to connect to a locally running Dwarf Fortress game through DFHack's RPC connection."
+    description="A MCP server that uses the dfhack_client_python package to connect to a locally running Dwarf Fortress game through DFHack's RPC connection.",
+    # Duplicates of other tools offered only to plain HTTP clients; MCP can't return raw protobuf
+    exclude_operations=["get_view_info_protobuf", "list_units_query"]
 )
 mcp.mount()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Each worker opens its own DFHack connection in lifespan. MCP SSE sessions live in the worker that
+    # accepted them, so only raise this behind a proxy with session affinity
+    workers = int(os.environ.get("DFHACK_MCP_WORKERS", "1"))
+    # Multiple workers need an import string to load the app in each process
+    uvicorn.run("main:app" if workers > 1 else app, host="0.0.0.0", port=8000, workers=workers)